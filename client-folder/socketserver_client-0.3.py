@@ -6,21 +6,53 @@ https://docs.python.org/3.6/library/socketserver.html#module-socketserver
 """
 import argparse
 
+import os
+import queue
+import re
 import socket
+import stat
+import struct
 import sys
+import threading
 
 import logging
 
-from pathlib import Path
-
 # Provided example file hardcoded PORT, so we will too
 PORT = 2345
 
 FILE_DIR = './'  # Just use the current directory
 FN_LIMIT = 255  # Number of chars that can be in a filename
 
-SEP = "<SEPARATOR>" # Used to separate request commands
-BUFFER_SIZE = 4096  # How much data is sent each iteration
+SEP = "<SEPARATOR>" # Used to separate server response fields
+# Server response: command letter and its first field. Anything after that
+# (e.g. the start of the file for 'g') is left where it is in the buffer.
+RESP_RE = re.compile(rb'([sged])' + re.escape(bytes(SEP, 'ascii')) 
+    + rb'(.*?)(?:' + re.escape(bytes(SEP, 'ascii')) + rb'|\Z)', re.DOTALL)
+# Initial request header: command, filename length, then the file size ('w')
+# or the start and end byte ('g'). The filename follows the header.
+REQ_HEADER = struct.Struct('!BHqq')
+
+
+def chunk_size(default=1 << 17):
+    r"""
+    Read the chunk size from FILESERVER_CHUNK, falling back to default if it
+    is not a number. Rounded down to a multiple of 4 KiB and clamped between
+    4 KiB and 1 MiB.
+    """
+    try:
+        size = int(os.environ.get('FILESERVER_CHUNK', default))
+    except ValueError:
+        size = default
+    size -= size % 4096
+    return min(max(size, 4096), 1 << 20)
+
+
+# How much data is sent each iteration. Override with the FILESERVER_CHUNK
+# environment variable.
+BUFFER_SIZE = chunk_size()
+# Socket buffers smaller than SOCK_BUF_MIN are raised, up to SOCK_BUF_MAX
+SOCK_BUF_MIN = 1 << 20
+SOCK_BUF_MAX = 16 << 20
 
 def parse_args():
     '''
@@ -56,14 +88,23 @@ def construct_client_request(start_b, end_b, write, fn):
     logging.debug('Constructing Initial Request with following:')
     logging.debug('start_b: {} | end_b: {} | write: {} | fn: {}'
                     .format(start_b, end_b, write, fn))
+    fn_bytes = bytes(fn, 'utf-8')
+    if len(fn_bytes) > FN_LIMIT:
+        print('USER ERROR: The file name {} is too long'.format(fn))
+        return False
                     
     if write:
         logging.debug('User is requesting to upload {}'.format(fn)) 
-        p = Path('{}{}'.format(FILE_DIR, fn))
-        if p.is_file():
+        p = '{}{}'.format(FILE_DIR, fn)
+        try:
+            # One stat() gives us both the file type and its size
+            st = os.stat(p)
+        except OSError:
+            st = None
+        if st is not None and stat.S_ISREG(st.st_mode):
             # Check if the file actually exists in the current directory
             logging.debug('File exists and is not a directory')
-            file_size = p.stat().st_size
+            file_size = st.st_size
             logging.debug('File size: {} Bytes'.format(file_size))
         else:
             # File specified doesn't exist
@@ -72,16 +113,22 @@ def construct_client_request(start_b, end_b, write, fn):
             print('When using \'-w\' flag, you are sending to the server.')
             print('Please input a filename that exists and try again.')
             return False
-        # we want to download file from the server
-        # w means client wants to write. Use a seperator for easy way to
-        # distinguish between separate parts of our message to server.
-        request = f'w{SEP}{fn}{SEP}{file_size}'
+        # w means client wants to write. The header carries the file size
+        # and the filename follows it.
+        request = REQ_HEADER.pack(ord('w'), len(fn_bytes), file_size, 0)
+        request += fn_bytes
         logging.debug('Request: {}'.format(request))
         return request
     else:
         logging.debug('User is requesting to download {}'.format(fn))
-        # s<SEP>fn<SEP>sb<SEP>eb
-        request = 'g{}{}{}{}{}{}'.format(SEP, fn, SEP, start_b, SEP, end_b)
+        # g means client wants to get a file. Start at byte 0 and stop at
+        # the last byte (-1) when they were not given.
+        if start_b is None:
+            start_b = 0
+        if end_b is None:
+            end_b = -1
+        request = REQ_HEADER.pack(ord('g'), len(fn_bytes), start_b, end_b)
+        request += fn_bytes
         logging.debug('Request: {}'.format(request))
         return request
     
@@ -93,11 +140,57 @@ def process_request(request):
     Process the request with the server that the client wants based on their
     command line input.
     """
-    if request[0] == 'w':
+    if request[0] == ord('w'):
         logging.debug('Processing Write to Server request')
         
     logging.debug('Finished Processing Request.')
     return
+
+
+def tune_socket_buffers(sock):
+    r"""
+    Raise the send and receive buffers of sock when they are small enough
+    to limit a single transfer. Nothing is changed if the kernel autotunes
+    them, since setting them by hand turns autotuning off for the socket.
+    """
+    for opt, name in ((socket.SO_SNDBUF, 'SO_SNDBUF'), 
+            (socket.SO_RCVBUF, 'SO_RCVBUF')):
+        size = sock.getsockopt(socket.SOL_SOCKET, opt)
+        if not AUTOTUNED_BUFFERS and size < SOCK_BUF_MIN:
+            sock.setsockopt(socket.SOL_SOCKET, opt, 
+                min(SOCK_BUF_MAX, size * 4))
+            size = sock.getsockopt(socket.SOL_SOCKET, opt)
+        logging.debug(f'{name} is {size} bytes')
+
+
+def buffers_autotuned():
+    r"""
+    Check if the kernel sizes TCP buffers itself (Linux only).
+    """
+    try:
+        with open('/proc/sys/net/ipv4/tcp_moderate_rcvbuf') as f:
+            return f.read().strip() == '1'
+    except OSError:
+        return False
+
+AUTOTUNED_BUFFERS = buffers_autotuned()
+
+
+def read_file_chunks(f, chunks):
+    r"""
+    Read f BUFFER_SIZE at a time onto the chunks queue so the next chunk is
+    read from disk while the last one is being sent. None marks the end, and
+    an exception raised while reading is queued in place of it.
+    """
+    try:
+        bytes_read = f.read(BUFFER_SIZE)
+        while bytes_read:
+            chunks.put(bytes_read)
+            bytes_read = f.read(BUFFER_SIZE)
+    except Exception as e:
+        chunks.put(e)
+    else:
+        chunks.put(None)
         
 
 if __name__ == '__main__':
@@ -130,26 +223,46 @@ if __name__ == '__main__':
     logging.debug('Attempting to create a socket')
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
         logging.debug('Created a socket.')
+        # Before connect() so the receive buffer counts for window scaling
+        tune_socket_buffers(sock)
         
         logging.debug('Attempting connection to {}:{}'.format(HOST, PORT))
         sock.connect((HOST, PORT))
         logging.debug('Connection established.')
+        # Don't let Nagle hold back our small request message
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         
         logging.debug('Sending Request.')
-        sock.sendall(bytes(request + "\n", "utf-8"))
+        sock.sendall(request)
         logging.debug('Request sent. Waiting for response from server')
 
         
-        received = str(sock.recv(1024), "ascii").split(SEP)
+        # Only the header is text. A 'g' response already carries the
+        # start of the file after the last separator.
+        data = sock.recv(BUFFER_SIZE)
         logging.debug('Received data back from server.')
+        match = RESP_RE.match(data)
+        if match:
+            # The field may hold the filename, which is UTF-8
+            received = [str(match[1], 'ascii'), str(match[2], 'utf-8')]
+        else:
+            received = [None, data]
         if received[0] == 's':
             # Server wants us to send the file
             logging.debug(f'Packaging {FILE_DIR}{args.file_name} to send')
             with open(f'{FILE_DIR}{args.file_name}', 'rb') as f:
-                bytes_read = f.read(BUFFER_SIZE)
-                while bytes_read:
+                # Disk reads happen on another thread, a few chunks ahead
+                chunks = queue.Queue(maxsize=4)
+                reader = threading.Thread(target=read_file_chunks, 
+                    args=(f, chunks), daemon=True)
+                reader.start()
+                bytes_read = chunks.get()
+                while bytes_read is not None:
+                    if isinstance(bytes_read, Exception):
+                        raise bytes_read
                     sock.sendall(bytes_read)
-                    bytes_read = f.read(BUFFER_SIZE)
+                    bytes_read = chunks.get()
+                reader.join()
                 print(f'Successfully sent {args.file_name} to server.')
                 logging.debug('Done sending all bytes')
             sock.close()
@@ -158,21 +271,21 @@ if __name__ == '__main__':
             file_size = int(received[1])
             print('File is {} Bytes'.format(file_size))
             with open(f'{FILE_DIR}{args.file_name}', 'wb') as f:
-                if BUFFER_SIZE >= file_size:
-                    # Don't want to read too much into the file.
-                    bytes_read = sock.recv(file_size)
-                    bytes_left = 0
-                else:
-                    bytes_read = sock.recv(BUFFER_SIZE)
-                    bytes_left = file_size - BUFFER_SIZE
-                while bytes_read:
-                    f.write(bytes_read)
-                    if bytes_left < BUFFER_SIZE:
-                        bytes_read = sock.recv(bytes_left)
-                        bytes_left = 0
-                    else:
-                        bytes_read = sock.recv(BUFFER_SIZE)
-                        bytes_left = bytes_left - BUFFER_SIZE
+                bytes_read = memoryview(data)[match.end():][:file_size]
+                f.write(bytes_read)
+                bytes_left = file_size - len(bytes_read)
+                # Receive into the same buffer every time
+                buf = bytearray(BUFFER_SIZE)
+                view = memoryview(buf)
+                while bytes_left:
+                    # Don't want to read too much into the file. recv() can
+                    # return less than asked for, so count what we got.
+                    bytes_read = sock.recv_into(buf, min(BUFFER_SIZE, 
+                        bytes_left))
+                    if not bytes_read:
+                        break
+                    f.write(view[:bytes_read])
+                    bytes_left -= bytes_read
                 f.close()
             logging.debug('Done receiving all bytes')
             sock.close()   
@@ -13,7 +13,7 @@ Features were added to meet project requirements summarized below:
     the server:
     Before Starting:
     % Sending <filename> to <client's-IP-address>
-    During:
+    During (only when stdout is a terminal):
     % Sent 10% of <filename>
     % Sent 20% of <filename>
     ...
@@ -31,20 +31,137 @@ Features were added to meet project requirements summarized below:
 """
 import argparse
 import logging
+import os
+import queue
 
 import threading
 
+import selectors
 import socket
 import socketserver
+import stat
+import struct
+import sys
 
-from pathlib import Path
+try:
+    import fcntl
+except ImportError:
+    fcntl = None    # Windows
+
+from concurrent.futures import ThreadPoolExecutor
 
 # Set to True if you want to enable debugging messages for the server
 DEBUG = False
 
 FILE_DIR = './hosted-files/'
-SEP = "<SEPARATOR>" # Used to separate portions of request messages
-BUFFER_SIZE = 4096  # How much data is sent each iteration
+# FILE_DIR resolved once, as bytes so paths need no encoding per syscall
+FILE_ROOT = os.fsencode(os.path.abspath(FILE_DIR))
+SEP = "<SEPARATOR>" # Used to separate portions of response messages
+# Initial request header: command, filename length, then the file size ('w')
+# or the start and end byte ('g'). The filename follows the header.
+REQ_HEADER = struct.Struct('!BHqq')
+
+
+def chunk_size(default=1 << 17):
+    r"""
+    Read the chunk size from FILESERVER_CHUNK, falling back to default if it
+    is not a number. Rounded down to a multiple of 4 KiB and clamped between
+    4 KiB and 1 MiB.
+    """
+    try:
+        size = int(os.environ.get('FILESERVER_CHUNK', default))
+    except ValueError:
+        size = default
+    size -= size % 4096
+    return min(max(size, 4096), 1 << 20)
+
+
+# How much data is sent each iteration. Override with the FILESERVER_CHUNK
+# environment variable.
+BUFFER_SIZE = chunk_size()
+SENDFILE_CHUNK = 1 << 20    # Max bytes per sendfile() call
+USE_SENDFILE = hasattr(os, 'sendfile')   # Zero-copy sends where supported
+# Buffer size for files sent with send_file_chunks(). sendfile() reads from
+# the page cache itself, so there the only read is the first chunk, which
+# goes straight into a pooled buffer with no file buffer in between.
+READ_BUFFER = 0 if USE_SENDFILE else 1 << 20
+USE_FADVISE = hasattr(os, 'posix_fadvise')  # Readahead hints where supported
+USE_CORK = hasattr(socket, 'TCP_CORK')  # Only full segments while sending
+USE_SPLICE = hasattr(os, 'splice')  # In-kernel receives (Linux)
+# Progress lines are only for someone watching. Skipping them otherwise keeps
+# handler threads from queuing up on the stdout lock.
+PRINT_PROGRESS = sys.stdout.isatty()
+# Socket buffers smaller than SOCK_BUF_MIN are raised, up to SOCK_BUF_MAX
+SOCK_BUF_MIN = 1 << 20
+SOCK_BUF_MAX = 16 << 20
+
+# BUFFER_SIZE buffers shared by the handler threads so every transfer doesn't
+# allocate its own. Holds at most 2 spare buffers per CPU.
+_BUFFER_POOL = queue.LifoQueue(maxsize=2 * (os.cpu_count() or 1))
+
+
+def get_buf():
+    r"""
+    Take a buffer from the pool, or allocate a new one if it is empty.
+    """
+    try:
+        return _BUFFER_POOL.get_nowait()
+    except queue.Empty:
+        return bytearray(BUFFER_SIZE)
+
+
+def put_buf(buf):
+    r"""
+    Return a buffer to the pool. It is dropped if the pool is full.
+    """
+    try:
+        _BUFFER_POOL.put_nowait(buf)
+    except queue.Full:
+        pass
+
+
+def tune_socket_buffers(sock):
+    r"""
+    Raise the send and receive buffers of sock when they are small enough
+    to limit a single transfer. Nothing is changed if the kernel autotunes
+    them, since setting them by hand turns autotuning off for the socket.
+    """
+    for opt, name in ((socket.SO_SNDBUF, 'SO_SNDBUF'), 
+            (socket.SO_RCVBUF, 'SO_RCVBUF')):
+        size = sock.getsockopt(socket.SOL_SOCKET, opt)
+        if not AUTOTUNED_BUFFERS and size < SOCK_BUF_MIN:
+            sock.setsockopt(socket.SOL_SOCKET, opt, 
+                min(SOCK_BUF_MAX, size * 4))
+            size = sock.getsockopt(socket.SOL_SOCKET, opt)
+        logging.debug(f'{name} is {size} bytes')
+
+
+def buffers_autotuned():
+    r"""
+    Check if the kernel sizes TCP buffers itself (Linux only).
+    """
+    try:
+        with open('/proc/sys/net/ipv4/tcp_moderate_rcvbuf') as f:
+            return f.read().strip() == '1'
+    except OSError:
+        return False
+
+AUTOTUNED_BUFFERS = buffers_autotuned()
+
+
+def resolve_path(fn):
+    r"""
+    Turn a filename from the client into a path directly inside FILE_DIR.
+    Raises ValueError if it would point anywhere else, subdirectories
+    included.
+    """
+    name = os.fsencode(fn)
+    if b'\0' in name:
+        raise ValueError(f'{fn!r} contains a null byte')
+    path = os.path.normpath(os.path.join(FILE_ROOT, name))
+    if os.path.dirname(path) != FILE_ROOT:
+        raise ValueError(f'{fn!r} is not directly inside {FILE_DIR}')
+    return path
 
 class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
     """
@@ -54,26 +171,42 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
     (file-like objects that simplify communication by providing the standard
     file interface):
     """
+    # StreamRequestHandler.setup() sets TCP_NODELAY on the connection so
+    # our small control messages go out without waiting on Nagle.
+    disable_nagle_algorithm = True
+    # Seconds a client may stall before we give up on it, so a client that
+    # connects and sends nothing can't hold on to a worker thread.
+    timeout = 30
+
     def handle(self):
         logging.debug('Received a new TCP request.')
         logging.debug('Client IP: {}'.format(self.client_address[0]))
         self.processed_init_cmd = False    # Initial Command not set
-        # Get the initial command from the client.
-        self.init_cmd = self.get_init_cmd()
-        
-        if self.init_cmd:
-            logging.debug('Received a valid initial command')
-            # Ready to process initial command
-            if self.process_init_cmd():
-                final_resp = bytes(f'd{SEP}PROCESS COMPLETE', 'ascii')
+        try:
+            # Get the initial command from the client.
+            self.init_cmd = self.get_init_cmd()
+            
+            if self.init_cmd:
+                logging.debug('Received a valid initial command')
+                # Ready to process initial command
+                if self.process_init_cmd():
+                    final_resp = bytes(f'd{SEP}PROCESS COMPLETE', 'ascii')
+                else:
+                    final_resp = bytes(f'e{SEP}Something went wrong.', 
+                        'ascii')
             else:
-                final_resp = bytes(f'e{SEP}Something went wrong.', 'ascii')
-        else:
-            logging.debug('Received invalid initial command')
-            final_resp = bytes(f'e{SEP}Unknown Initial Command', 'ascii')
+                logging.debug('Received invalid initial command')
+                final_resp = bytes(f'e{SEP}Unknown Initial Command', 'ascii')
+        except socket.timeout:
+            logging.debug('Timed out waiting on the client.')
+            final_resp = bytes(f'e{SEP}Timed out.', 'ascii')
         
         logging.debug('Sending Final Response')
-        self.request.sendall(final_resp)
+        try:
+            self.request.sendall(final_resp)
+        except OSError:
+            # Client is gone or not reading. Nothing more we can do.
+            logging.debug('Could not send final response.')
         
         logging.debug('Closing TCP Request.')
         self.request.close()
@@ -87,13 +220,25 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
         """
         logging.debug('Processing initial client command.')
         init_cmd = self.init_cmd[0]
+        self.fn = self.init_cmd[1]
+        try:
+            self.path = resolve_path(self.fn)
+        except ValueError as e:
+            logging.debug(f'Rejecting file name: {e}')
+            resp = bytes(f'e{SEP}Invalid file name.', 'ascii')
+            self.request.sendall(resp)
+            return False
         
         if init_cmd == 'w':
-            self.fn = self.init_cmd[1]
-            self.file_size = int(self.init_cmd[2])
+            self.file_size = self.init_cmd[2]
             logging.debug('Beginning process to write file to server.')
             logging.debug('Name: {} | Size: {}'.format(self.fn, 
                 self.file_size))
+            if self.file_size < 0:
+                logging.debug('Provided file size is illogical. Return error.')
+                resp = bytes(f'e{SEP}Invalid file size.', 'ascii')
+                self.request.sendall(resp)
+                return False
             receive_ready, resp = self.receive_ready_check(self.fn, 
                 self.file_size)
             if receive_ready:
@@ -101,8 +246,7 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
                 logging.debug('Sending Client CMD to send file')
                 self.request.sendall(resp)
                 self.receive_file()
-                # Reception was successful
-                process_status = True
+                process_status = self.successful_receive
             else:
                 logging.debug('We are NOT ready to receive a file.')
                 resp = bytes(f'e{SEP}FILE EXISTS ON SERVER. RENAME FILE.', 
@@ -110,26 +254,17 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
                 self.request.sendall(resp)
                 process_status = False
         if init_cmd == 'g':
-            self.fn = self.init_cmd[1]
-            try:
-                self.start_byte = int(self.init_cmd[2])
-            except ValueError:
-                # must be set to None?
-                self.start_byte = 0
-            try:
-                self.end_byte = int(self.init_cmd[3])
-            except ValueError:
-                # Must be set to None? Use -1 as last byte for
-                self.end_byte = -1
+            # Client sends 0 and -1 when no start or end byte was given
+            self.start_byte = self.init_cmd[2]
+            self.end_byte = self.init_cmd[3]
             logging.debug('Beginning process of sending a file to client.')
             logging.debug('Name: {} | Start Byte: {} | End Byte {}'.format(
                 self.fn, self.start_byte, self.end_byte))
             send_ready, resp = self.send_ready_check()
             if send_ready:
                 logging.debug('We are ready to send a file.')
-                self.request.sendall(resp)
-                logging.debug('Sent Client CMD to send file')
-                self.send_file()
+                # resp goes out in the same send as the start of the file
+                self.send_file(prefix=resp)
                 process_status = True
             else:
                 logging.debug('We are NOT ready to send a file.')
@@ -140,10 +275,14 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
         logging.debug('Successfully processed initial command')
         return process_status
 
-    def send_file(self):
+    def send_file(self, prefix=b''):
         r"""
         Send a file to a client. Bunch of extra stuff in here to display
         what % of file has been sent.
+
+        If given, prefix (the response to the client) is sent together with
+        the first chunk of the file so the two don't go out as separate
+        segments.
         """
         self.successful_send = False
         print(f'Sending {self.fn} to {self.client_address[0]}')
@@ -151,55 +290,50 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
             self.end_byte))
         
         ### For the progress
-        tot_bytes_sent = 0
-        bytes_left = self.file_size
-        try:
-            percent_sent = tot_bytes_sent / bytes_left * 100
-        except ZeroDivisionError:
-            # User might be requesting an empty file
-            percent_sent = 0
-        percent_printed = 0
+        self.tot_bytes_sent = 0
+        self.percent_printed = 0
+        # Byte count at which the next 10% has been sent
+        self.next_progress = self.progress_mark(10)
         ### Begin opening and sending bytes
-        with open(f'{FILE_DIR}{self.fn}', 'rb') as f:
-            f.seek(self.start_byte) # Start reading file at start byte
-            logging.debug(f'Opened file at byte: {f.tell()}')
-            if BUFFER_SIZE >= bytes_left:
-                bytes_read = f.read(bytes_left)
-                bytes_left = 0
-            else:
-                bytes_read = f.read(BUFFER_SIZE)
-                bytes_left = bytes_left - BUFFER_SIZE
-            while bytes_read: 
-                self.request.sendall(bytes_read)
-                if self.file_size < BUFFER_SIZE:
-                    # More stuff for progress percentage.
-                    tot_bytes_sent += self.file_size
-                else:
-                    tot_bytes_sent += BUFFER_SIZE
-                try:
-                    percent_sent = tot_bytes_sent / self.file_size * 100
-                    percent_sent = percent_sent - (percent_sent % 10)
-                except ZeroDivisionError:
-                    # We are sending an empty file
-                    percent_sent = 100 # automatically 100 percent sent
-                if (percent_sent > percent_printed):
-                    while percent_printed < percent_sent:
-                        print(f'Sent {percent_printed}% of {self.fn}')
-                        percent_printed += 10
-                if bytes_left >= BUFFER_SIZE:
-                    bytes_read = f.read(BUFFER_SIZE)
-                    bytes_left -= BUFFER_SIZE
+        buf = get_buf()
+        if USE_CORK:
+            # Only send full segments, so the response and the last bit of
+            # the file don't go out as small packets of their own.
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+        try:
+            with open(self.path, 'rb', 
+                    buffering=READ_BUFFER) as f, memoryview(buf) as view:
+                if USE_FADVISE:
+                    # We read the range front to back, so let the kernel
+                    # read ahead while we are busy sending.
+                    for advice in (os.POSIX_FADV_SEQUENTIAL, 
+                            os.POSIX_FADV_WILLNEED):
+                        os.posix_fadvise(f.fileno(), self.start_byte, 
+                            self.file_size, advice)
+                if prefix:
+                    f.seek(self.start_byte) # Start reading file at start byte
+                    bytes_read = f.readinto(view[:self.file_size])
+                    self.request.sendall(prefix + view[:bytes_read])
+                    logging.debug('Sent Client CMD to send file')
+                    self.update_progress(bytes_read)
+                if USE_SENDFILE:
+                    # Kernel copies straight from the page cache to the socket
+                    self.send_file_zero_copy(f)
                 else:
-                    bytes_read = f.read(bytes_left)
-                    bytes_left = 0
+                    self.send_file_chunks(f, view)
+        finally:
+            if USE_CORK:
+                # Flush whatever is still held back
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 
+                    0)
+            put_buf(buf)
                 
-        percent_sent = 100  # Just do this in case of empty file.
-        if (percent_sent > percent_printed):
-            # If we send an empty file still display progress
-            while percent_printed < percent_sent:
-                print(f'Sent {percent_printed}% of {self.fn}')
-                percent_printed += 10
-        print(f'Sent 100% of {self.fn}')
+        if PRINT_PROGRESS:
+            # Whatever is left up to 100%, written in one go
+            lines = [f'Sent {percent}% of {self.fn}\n' 
+                for percent in range(self.percent_printed, 100, 10)]
+            lines.append(f'Sent 100% of {self.fn}\n')
+            sys.stdout.write(''.join(lines))
                 
         self.successful_send = True
         print(f'Finished sending {self.fn} to {self.client_address[0]}')
@@ -207,6 +341,74 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
         return
 
 
+    def send_file_zero_copy(self, f):
+        r"""
+        Send what is left of the requested byte range of f with
+        socket.sendfile(). Capped at SENDFILE_CHUNK per call so the progress
+        can still be displayed.
+        """
+        offset = self.start_byte + self.tot_bytes_sent
+        bytes_left = self.file_size - self.tot_bytes_sent
+        logging.debug(f'Sending with sendfile() from byte: {offset}')
+        while bytes_left:
+            bytes_sent = self.request.sendfile(f, offset, 
+                min(SENDFILE_CHUNK, bytes_left))
+            if not bytes_sent:
+                break
+            offset += bytes_sent
+            bytes_left -= bytes_sent
+            self.update_progress(bytes_sent)
+        return
+
+
+    def send_file_chunks(self, f, view):
+        r"""
+        Send what is left of the requested byte range of f by reading it
+        into view one buffer at a time. Used where os.sendfile() is not
+        available.
+        """
+        bytes_left = self.file_size - self.tot_bytes_sent
+        f.seek(self.start_byte + self.tot_bytes_sent)
+        logging.debug(f'Opened file at byte: {f.tell()}')
+        while bytes_left:
+            bytes_read = f.readinto(view[:bytes_left])
+            if not bytes_read:
+                break
+            self.request.sendall(view[:bytes_read])
+            bytes_left -= bytes_read
+            self.update_progress(bytes_read)
+        return
+
+
+    def update_progress(self, bytes_sent):
+        r"""
+        Add to the number of bytes sent and print every 10% of the file
+        that has been sent so far.
+        """
+        self.tot_bytes_sent += bytes_sent
+        if self.tot_bytes_sent < self.next_progress:
+            return
+        first_percent = self.percent_printed
+        while self.tot_bytes_sent >= self.next_progress:
+            self.percent_printed += 10
+            self.next_progress = self.progress_mark(self.percent_printed + 10)
+        if PRINT_PROGRESS:
+            # One write for however many 10% steps this chunk covered
+            sys.stdout.write(''.join(f'Sent {percent}% of {self.fn}\n' 
+                for percent in range(first_percent, self.percent_printed, 10)))
+        return
+
+
+    def progress_mark(self, percent):
+        r"""
+        How many bytes make up percent% of the file, rounded up. Anything
+        past 100% is more than the whole file so it is never reached.
+        """
+        if percent > 100:
+            return self.file_size + 1
+        return -(-percent * self.file_size // 100)
+
+
     def send_ready_check(self):
         r"""
         Check that we are ready to fulfill client request to receive a file.
@@ -217,7 +419,7 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
         if self.file_exists():
             # File must exist to send it...
             logging.debug(f'The file {fn} exists in our directory')
-            self.file_size = self.p.stat().st_size
+            self.file_size = self.st.st_size
             if self.end_byte == 'EOF':
                 self.end_byte = self.file_size 
             logging.debug(f'File Size: {self.file_size}')
@@ -236,7 +438,8 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
         else:
             # File does not exist
             logging.debug(f'The file {fn} does not exist on server.')
-            response = bytes(f'e{SEP}{fn} Does not exist on server.', 'ascii')
+            # fn came from the client as UTF-8, so send it back the same way
+            response = bytes(f'e{SEP}{fn} Does not exist on server.', 'utf-8')
             return False, response
             
         logging.debug('Should never reach here. [receive_ready_check()]')
@@ -261,34 +464,121 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
 
     def receive_file(self):
         r"""
-        Receive a file from the client.
+        Receive a file from the client. Exactly file_size bytes are read, so
+        we stop at the end of the file rather than waiting for the client
+        to close the connection.
         """
         self.successful_receive = False
-        # What if client never ends up sending the file?
-        with open(f'{FILE_DIR}{self.fn}', 'wb') as f:
-            bytes_read = self.request.recv(BUFFER_SIZE)
-            while bytes_read:
-                f.write(bytes_read)
-                bytes_read = self.request.recv(BUFFER_SIZE)
-            f.close()
-        self.successful_receive = True
+        f = open(self.path, 'wb')
+        try:
+            # What if client never ends up sending the file?
+            with f:
+                if USE_SPLICE:
+                    # Kernel moves the data from the socket to the file
+                    bytes_left = self.receive_file_splice(f)
+                else:
+                    bytes_left = self.receive_file_chunks(f)
+            if bytes_left > 0:
+                logging.debug('Client closed connection early.')
+            self.successful_receive = bytes_left == 0
+        finally:
+            if not self.successful_receive:
+                # A partial file would make every retry fail as existing
+                logging.debug('Removing partially received file.')
+                os.unlink(self.path)
         response = bytes('Finished receiving your file.', 'ascii')
         return
 
+
+    def receive_file_splice(self, f):
+        r"""
+        Move the upload from the socket into f with os.splice() through a
+        pipe, so the data is never copied into Python. Returns how many
+        bytes were not received.
+        """
+        bytes_left = self.file_size
+        pipe_r, pipe_w = os.pipe()
+        # The handler timeout makes the socket non-blocking, so wait for
+        # data ourselves the way recv() would.
+        selector = selectors.DefaultSelector()
+        selector.register(self.request, selectors.EVENT_READ)
+        try:
+            if fcntl is not None:
+                try:
+                    # Room for BUFFER_SIZE at a time instead of 64 KiB
+                    fcntl.fcntl(pipe_w, fcntl.F_SETPIPE_SZ, BUFFER_SIZE)
+                except OSError:
+                    pass    # Above the pipe size limit. Default still works.
+            while bytes_left > 0:
+                try:
+                    bytes_read = os.splice(self.request.fileno(), pipe_w, 
+                        min(BUFFER_SIZE, bytes_left))
+                except BlockingIOError:
+                    if not selector.select(self.timeout):
+                        raise socket.timeout('timed out')
+                    continue
+                if not bytes_read:
+                    break
+                bytes_left -= bytes_read
+                while bytes_read:
+                    bytes_read -= os.splice(pipe_r, f.fileno(), bytes_read)
+        finally:
+            selector.close()
+            os.close(pipe_r)
+            os.close(pipe_w)
+        return bytes_left
+
+
+    def receive_file_chunks(self, f):
+        r"""
+        Receive the upload into a pooled buffer and write it to f. Used
+        where os.splice() is not available. Returns how many bytes were
+        not received.
+        """
+        bytes_left = self.file_size
+        # Receive into the same buffer every time instead of a new bytes
+        buf = get_buf()
+        try:
+            with memoryview(buf) as view:
+                while bytes_left > 0:
+                    bytes_read = self.request.recv_into(buf, 
+                        min(BUFFER_SIZE, bytes_left))
+                    if not bytes_read:
+                        break
+                    f.write(view[:bytes_read])
+                    bytes_left -= bytes_read
+        finally:
+            put_buf(buf)
+        return bytes_left
+
        
     def get_init_cmd(self):
         r"""
         Process the initial command from the client and decide
         what to do from there.
         """
-        init_receive = str(self.request.recv(BUFFER_SIZE), 'ascii').split(SEP)
-        init_cmd = init_receive[0]
+        header = self.recvall(REQ_HEADER.size)
+        if len(header) < REQ_HEADER.size:
+            logging.debug('Client closed connection before sending a command.')
+            return False
+        cmd, fn_len, arg1, arg2 = REQ_HEADER.unpack(header)
+        name = self.recvall(fn_len)
+        if len(name) < fn_len:
+            logging.debug('Client closed connection before sending the filename.')
+            return False
+        try:
+            fn = str(name, 'utf-8')
+        except UnicodeDecodeError:
+            logging.debug('Filename from client is not valid UTF-8.')
+            return False
+        init_cmd = chr(cmd)
+        init_receive = [init_cmd, fn, arg1, arg2]
         
-        if init_cmd[0] == 'w':
+        if init_cmd == 'w':
             logging.debug('Client wants to write a file to the server.')
             return init_receive
             # Kick off receive
-        elif init_cmd[0] == 'g':
+        elif init_cmd == 'g':
             logging.debug('Client wants to get a file from the server.')
             return init_receive
         else:
@@ -296,6 +586,20 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
             
         return False
         
+
+    def recvall(self, n):
+        r"""
+        Receive exactly n bytes from the client. Fewer are only returned
+        if the client closes the connection first.
+        """
+        data = self.request.recv(n)
+        while data and len(data) < n:
+            packet = self.request.recv(n - len(data))
+            if not packet:
+                break
+            data += packet
+        return data
+
        
     def receive_ready_check(self, fn, file_size):      
         logging.debug(f'Attempting to receive {fn}')
@@ -308,7 +612,7 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
         else:
             # We are ready to receive the file now
             logging.debug('Asking the client to send the file')
-            response = bytes(f's{SEP}{self.fn}{SEP}{self.file_size}', 'ascii')
+            response = bytes(f's{SEP}{self.fn}{SEP}{self.file_size}', 'utf-8')
             return True, response
             
         logging.debug('Should never reach here. [receive_ready_check()]')
@@ -323,12 +627,14 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
         
         logging.debug('Checking if the file exists: {}'.format(fn))
         
-        p = Path('{}{}'.format(FILE_DIR, fn))
-        logging.debug('Path object created: {}'.format(p))
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            st = None
         
-        if p.is_file():
+        if st is not None and stat.S_ISREG(st.st_mode):
             logging.debug('File exists and is not a directory')
-            self.p = p  # Other functions may want to use this now.
+            self.st = st  # Other functions may want to use this now.
             return True
         else:
             logging.debug('File does not exist nor is it a directory')
@@ -369,21 +675,81 @@ class ThreadedTCPRequestHandler(socketserver.StreamRequestHandler):
         return byte_bound_status
 
 
-class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-    pass
+class ThreadedTCPServer(socketserver.TCPServer):
+    """
+    TCP server that handles requests on a pool of reusable worker threads
+    instead of starting a new thread for every connection.
+    """
+    # Transfers block their thread, so this is how many can run at once.
+    # Threads are only started when none are idle, so a high cap costs
+    # nothing until there are that many clients at once.
+    max_workers = 1024
 
+    def __init__(self, *args, **kwargs):
+        # Created first since a failed bind calls server_close()
+        self.pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        super().__init__(*args, **kwargs)
 
-if __name__ == "__main__":
-    HOST, PORT = "localhost", 2345
-    if DEBUG:
-        logging.basicConfig(level=logging.DEBUG, 
-            format='%(asctime)s - %(levelname)s - %(message)s')
-        logging.debug('DEBUGGING Messages Enabled.')
-    
-    # Create the server, binding to localhost on port 2345
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, 
+            client_address)
+
+    def process_request_thread(self, request, client_address):
+        # Same as socketserver.ThreadingMixIn.process_request_thread
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown()
+
+
+def port_in_use(host, port):
+    r"""
+    Check if something is already bound to port by trying a plain bind.
+    Workers share the port with SO_REUSEPORT, which would otherwise let
+    them silently share it with an unrelated server too.
+    """
+    with socket.socket(ThreadedTCPServer.address_family, 
+            socket.SOCK_STREAM) as probe:
+        try:
+            probe.bind((host, port))
+        except OSError:
+            return True
+    return False
+
+
+def print_port_in_use(port):
+    print(f'Port {port} is current in use by the operating system.')
+    print('Change the port or wait until it is free.')
+
+
+def run_worker(host, port, cpu=None, reuse_port=False):
+    r"""
+    Run one server process. With reuse_port, each worker binds its own
+    listening socket to the same port with SO_REUSEPORT so the kernel
+    spreads new connections across them. If cpu is given the worker is
+    pinned to that CPU.
+    """
+    if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+        logging.debug(f'Worker {os.getpid()} pinned to CPU {cpu}')
     try:
-        with ThreadedTCPServer((HOST, PORT), 
-                ThreadedTCPRequestHandler) as server:
+        with ThreadedTCPServer((host, port), ThreadedTCPRequestHandler, 
+                bind_and_activate=False) as server:
+            if reuse_port:
+                # Must be set before bind()
+                server.socket.setsockopt(socket.SOL_SOCKET, 
+                    socket.SO_REUSEPORT, 1)
+            # Accepted connections inherit these, and the receive buffer
+            # has to be set before listen() for TCP window scaling to use it
+            tune_socket_buffers(server.socket)
+            server.server_bind()
+            server.server_activate()
             ip, port = server.server_address
             logging.debug('TCP Server activated at {}:{}'.format(ip, port))
             
@@ -395,7 +761,37 @@ if __name__ == "__main__":
             logging.debug('Server Thread Joined') # This never happens
             server.shutdown()
     except OSError:
-        print(f'Port {PORT} is current in use by the operating system.')
-        print('Change the port or wait until it is free.')
+        print_port_in_use(port)
+
+
+if __name__ == "__main__":
+    HOST, PORT = "localhost", 2345
+    if DEBUG:
+        logging.basicConfig(level=logging.DEBUG, 
+            format='%(asctime)s - %(levelname)s - %(message)s')
+        logging.debug('DEBUGGING Messages Enabled.')
+    
+    # Create the server, binding to localhost on port 2345
+    if hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT'):
+        if port_in_use(HOST, PORT):
+            print_port_in_use(PORT)
+            raise SystemExit(1)
+        # One worker process per CPU we are allowed to run on
+        if hasattr(os, 'sched_getaffinity'):
+            cpus = sorted(os.sched_getaffinity(0))
+        else:
+            cpus = [None] * (os.cpu_count() or 1)
+        workers = []
+        for cpu in cpus:
+            pid = os.fork()
+            if pid == 0:
+                run_worker(HOST, PORT, cpu, reuse_port=True)
+                os._exit(0)
+            workers.append(pid)
+        logging.debug(f'Started {len(workers)} worker processes')
+        for pid in workers:
+            os.waitpid(pid, 0)
+    else:
+        run_worker(HOST, PORT)
 
     logging.debug(f'End of function {__name__}')